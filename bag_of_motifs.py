@@ -618,7 +618,7 @@ def main(args):
         attach_smiles(args, dags)       
     train(args, dags, props, norm_props)
     with open(os.path.join(predictor_path, 'config.json'), 'w+') as f:
-        json.dump(json.dumps(args.__dict__), f)      
+        json.dump(args.__dict__, f, default=str)      
        
 
 
@@ -12,13 +12,17 @@ if __name__ == "__main__":
         config_path = os.path.join(work_dir, folder, "config.json")
         if not os.path.exists(config_path):
             continue
-        config = json.loads(json.load(open(config_path)))        
+        config = json.load(open(config_path))
+        if isinstance(config, str): # configs written before the double-encoding fix
+            config = json.loads(config)
         if 'motifs_folder' in config and 'group-contrib' in config['motifs_folder']:
             print(folder)
         else:
             continue
         try:
-            config = json.loads(json.load(open(os.path.join(work_dir, folder, "config.json"))))
+            config = json.load(open(os.path.join(work_dir, folder, "config.json")))
+            if isinstance(config, str):
+                config = json.loads(config)
         except FileNotFoundError:
             continue
         if 'motifs_folder' in config and 'group-contrib' in config['motifs_folder']:
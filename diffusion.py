@@ -1,9 +1,11 @@
 import argparse
 import pickle
+import sys
 import numpy as np
 np.random.seed(0)
 from utils import *
 import networkx as nx
+import scipy.sparse as sp
 import torch.nn as nn
 import torch
 import os
@@ -12,15 +14,61 @@ if 'TORCH_SEED' in os.environ:
     torch.manual_seed(seed)
 import torch.nn.functional as F
 import matplotlib.pyplot as plt
+import re
 import time
 import json
 from copy import deepcopy
-from math import factorial
+import heapq
+from itertools import chain, count
+from math import factorial, prod, fsum, log
+from functools import lru_cache
+factorial = lru_cache(maxsize=64)(factorial)
 from torch_geometric.nn.conv import GATConv, GCNConv, TransformerConv, GPSConv, GINConv
 from models.gnn_conv import MyGINConv as GINConv
 from torch_geometric.nn import aggr
 from multiprocessing import Pool
+import torch.multiprocessing as torch_mp
 from queue import PriorityQueue
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        def wrap(f):
+            return f
+        return wrap
+_debug_checks = bool(os.environ.get('DEBUG_CHECKS'))
+if os.environ.get('NO_BREAKPOINTS'): # stray breakpoints would hang pool workers
+    sys.breakpointhook = lambda *args, **kwargs: None
+try:
+    import orjson
+    def _json_dump(obj, path):
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS))
+except ImportError:
+    def _json_dump(obj, path):
+        with open(path, 'w+') as f:
+            json.dump(obj, f)
+
+
+@njit(cache=True)
+def unrank_permutation(idx, n, out):
+    """
+    fill out[0..n-1] with the idx-th permutation of range(n) in lexicographic
+    order (Lehmer-code decode over factorial-base digits)
+    """
+    avail = np.arange(n, dtype=np.int64)
+    f = 1
+    for k in range(2, n):
+        f *= k # (n-1)!
+    for i in range(n):
+        j = idx // f
+        idx = idx % f
+        out[i] = avail[j]
+        for k in range(j, n-i-1):
+            avail[k] = avail[k+1]
+        if i < n-1:
+            f //= n-1-i
+    return out
 
 
 class DiffusionProcess:
@@ -42,24 +90,71 @@ class DiffusionProcess:
         self.side_chains = side_chains
         self.main_chain = DiffusionProcess.compute_main_chain(dag)
         self.child_nums = [len(self.side_childs(a)) for a in self.main_chain[:-1]]
-        self.total = np.prod([factorial(x) for x in self.child_nums])        
+        self.child_facts = tuple(factorial(x) for x in self.child_nums)
+        self.total = prod(self.child_facts)
         self.split = split
         self.reset()
         if self.split:
-            res = []
-            self.dfs_walk(dag, res)
-            self.dfs_order = res
-            self.num_nodes = len(res)            
+            if not hasattr(dag, '_split_dfs_order'):
+                res = []
+                self.dfs_walk(dag, res)
+                dag._split_dfs_order = res
+            self.dfs_order = dag._split_dfs_order
+            self.num_nodes = len(self.dfs_order)
+            self._T = self.build_transition_matrix()
         else:
             self.dfs_dir = dfs_seed >= 0
             dfs_seed = abs(dfs_seed)
-            self.dfs_seed = dfs_seed % self.total # 0 to X-1, where X := prod_(node in main chain) num_childs(node)            
-            res = self.compute_dfs(dag)
-            new_res = self.augment_walk_order(res, dfs_seed)
-            if dfs_seed == 0:
-                assert res == new_res
-            self.dfs_order = new_res
-            self.num_nodes = len(res)
+            self.dfs_seed = dfs_seed % self.total # 0 to X-1, where X := prod_(node in main chain) num_childs(node)
+            cache = dag.__dict__.setdefault('_dfs_order_cache', {})
+            key = (self.dfs_dir, dfs_seed)
+            if key not in cache:
+                res = self.compute_dfs(dag)
+                new_res = self.augment_walk_order(res, dfs_seed)
+                if dfs_seed == 0:
+                    assert res == new_res
+                cache[key] = (new_res, len(res))
+            self.dfs_order, self.num_nodes = cache[key]
+        try:
+            self.dfs_order_idx = np.array([self.lookup[n.val] for n in self.dfs_order], dtype=np.int64)
+            self.dfs_order_idx_t = torch.as_tensor(self.dfs_order_idx)
+        except KeyError as e:
+            self.dfs_order_idx = self.dfs_order_idx_t = None
+            self._missing_key = e.args[0]
+        self._order_idx = self.dfs_order_idx
+
+
+    def build_transition_matrix(self):
+        """
+        one-time DAG walk into a sparse (N, N) matrix T with T[dest, src] the
+        transition probability, so step() is just a matvec
+        """
+        rows, cols, data = [], [], []
+        stack = [self.dag]
+        seen = set()
+        try:
+            while stack:
+                cur = stack.pop()
+                if id(cur) in seen:
+                    continue
+                seen.add(id(cur))
+                if cur.side_chain:
+                    if not self.side_chains: continue
+                    if not cur.children:
+                        rows.append(self.lookup[cur.parent[0].val])
+                        cols.append(self.lookup[cur.val])
+                        data.append(1.0)
+                else:
+                    for a in cur.children:
+                        rows.append(self.lookup[a[0].val])
+                        cols.append(self.lookup[cur.val])
+                        data.append(1.0/len(cur.children))
+                stack.extend(a[0] for a in cur.children)
+        except KeyError as e:
+            self._missing_key = e.args[0]
+            return None
+        N = len(self.lookup)
+        return sp.csr_matrix((data, (rows, cols)), shape=(N, N))
 
 
 
@@ -74,38 +169,41 @@ class DiffusionProcess:
         2) For each consecutive main chain nodes a and b, flip the order
         of res between a and b if dfs_dir
         """
-        indices = []
-        i = 0        
+        index_list = []
+        i = 0
         for j in range(len(res)):
             if res[j] == self.main_chain[i]:
-                indices.append(j)
+                index_list.append(j)
                 i += 1
-        new_res = []
+        indices = np.array(index_list, dtype=np.int64)
+        n = len(indices)
         start_node = dfs_seed//self.total
-        for step in range(len(indices)):
-            if self.dfs_dir:
-                start = (start_node+step)%len(indices)
-                end = (start_node+step+1)%len(indices)
-            else:
-                start = (start_node-step-1+len(indices))%len(indices)
-                end = (start_node-step+len(indices))%len(indices)            
+        if self.dfs_dir:
+            starts = (start_node+np.arange(n))%n
+        else:
+            starts = (start_node-np.arange(n)-1)%n
+        ends = (starts+1)%n
+        new_res = []
+        for start, end in zip(starts, ends):
             # we might loop back
             if indices[end] <= indices[start]:
-                new_res += (res[indices[start]:] + res[:indices[end]])
+                new_res.extend(res[indices[start]:])
+                new_res.extend(res[:indices[end]])
             else:
-                new_res += res[indices[start]: indices[end]]
+                new_res.extend(res[indices[start]: indices[end]])
         return new_res
 
 
-    def compute_dfs(self, dag):        
-        res = []        
+    def compute_dfs(self, dag):
+        res = []
         dfs_seed = self.dfs_seed
         perm_map = {}
         for i in range(len(self.child_nums)-1, -1, -1):
-            perm_idx = dfs_seed % factorial(self.child_nums[i])
-            perm = list(permutations(self.side_childs(self.main_chain[i])))[perm_idx]
-            perm_map[self.main_chain[i].id] = perm
-            dfs_seed //= factorial(self.child_nums[i])
+            perm_idx = dfs_seed % self.child_facts[i]
+            childs = self.side_childs(self.main_chain[i])
+            order = unrank_permutation(perm_idx, len(childs), np.empty(len(childs), dtype=np.int64))
+            perm_map[self.main_chain[i].id] = tuple(childs[j] for j in order)
+            dfs_seed //= self.child_facts[i]
         assert dfs_seed == 0
         self.dfs_walk(dag, res, perm_map)
         return res
@@ -113,7 +211,10 @@ class DiffusionProcess:
 
     @staticmethod
     def side_childs(a):
-        return [x for x in a.children if x[0].side_chain]        
+        # cached on the node; side_chain flags are stable once impose_order ran
+        if not hasattr(a, '_side_childs'):
+            a._side_childs = [x for x in a.children if x[0].side_chain]
+        return a._side_childs
     
     @staticmethod
     def impose_order(cur, add_main=False):
@@ -140,8 +241,10 @@ class DiffusionProcess:
         for Group Contribution, this is done already because of .side_chain during construction
         for other datasets, we need to impose an ordering
         by default, just use the id
-        """     
-        dfs_order = []        
+        """
+        if hasattr(dag, '_main_chain'):
+            return dag._main_chain
+        dfs_order = []
         need_impose = False
         DiffusionProcess.dfs_walk(dag, dfs_order)
         for cur in dfs_order:
@@ -169,78 +272,101 @@ class DiffusionProcess:
                     break
             else:
                 chain.append(dag)
+        dag._main_chain = chain
         return chain
 
 
     @staticmethod
-    def dfs_walk(node, res, perm_map=None):
-        """
-        perm_map: dict(node: permutation of child indices)
-        """
-        res.append(node)
-        childs = sorted(node.children, key=lambda x: (not x[0].side_chain, x[0].id)) # side chains first
+    def ordered_childs(node, perm_map=None):
+        # side chains first, each bucket by id; cheaper than a tuple-key sort
+        side, main = [], []
+        for c in node.children:
+            (side if c[0].side_chain else main).append(c)
+        if len(side) > 1:
+            side.sort(key=_child_id)
+        if len(main) > 1:
+            main.sort(key=_child_id)
+        childs = side + main
         if perm_map:
             try:
                 ind = [c[0].side_chain for c in childs].index(False)
             except:
-                ind = len(childs)        
+                ind = len(childs)
             if not node.side_chain: # reorder the children
                 childs[:ind] = perm_map[node.id]
-        for c in childs:
-            side_chain = c[0].side_chain
-            ind = len(res)-1
-            if c[0].id:
-                try:
-                    DiffusionProcess.dfs_walk(c[0], res, perm_map)
-                except:
-                    breakpoint()
-                if side_chain:
-                    for i in range(len(res)-2, ind-1, -1):
-                        res.append(res[i])
-                    # print([a.val for a in res[:ind+1]], [a.val for a in res], "before after")
+        return childs
+
+    @staticmethod
+    def dfs_walk(node, res, perm_map=None):
+        """
+        perm_map: dict(node: permutation of child indices)
+        iterative with an explicit stack; frames are
+        [node, ordered childs, next child index, (mirror start, side_chain) of the child in flight]
+        """
+        stack = [[node, None, 0, None]]
+        while stack:
+            frame = stack[-1]
+            if frame[1] is None:
+                res.append(frame[0])
+                frame[1] = DiffusionProcess.ordered_childs(frame[0], perm_map)
+            if frame[3] is not None:
+                ind, side_chain = frame[3]
+                frame[3] = None
+                if side_chain: # walk back up the side chain
+                    res.extend(res[ind:len(res)-1][::-1])
+            if frame[2] < len(frame[1]):
+                c = frame[1][frame[2]]
+                frame[2] += 1
+                if c[0].id:
+                    frame[3] = (len(res)-1, c[0].side_chain)
+                    stack.append([c[0], None, 0, None])
+            else:
+                stack.pop()
 
 
     
     def reset(self):
         self.t = 0
-        self.state = np.array([0.0 for _ in self.lookup])
+        self.state = np.zeros(len(self.lookup))
+        self._prev_idx = None
         if self.dag.val in self.lookup:
-            self.state[self.lookup[self.dag.val]] = 1.0
-            self.frontier = {self.dag: 1}       
+            self._prev_idx = self.lookup[self.dag.val]
+            self.state[self._prev_idx] = 1.0
+        # walk mode keeps only the current tape index; the one-hot is
+        # materialized lazily in get_state
+        self._cur_idx = self._shown_idx = self._prev_idx       
 
 
     def step(self):
-        new_frontier = defaultdict(float)
         if self.split:
-            for cur, p in self.frontier.items():
-                if cur.side_chain:
-                    if not self.side_chains: continue
-                    if cur.children:
-                        breakpoint()
-                        pass
-                    else:
-                        new_frontier[cur.parent[0]] += p
-                else:     
-                    for a in cur.children:
-                        new_frontier[a[0]] += p/len(cur.children)
+            if self._T is None:
+                raise KeyError(self._missing_key)
+            self.state = self._T.dot(self.state)
         else:
-            new_frontier[self.dfs_order[(self.t+1)%self.num_nodes]] = 1.0
-            
-                
-        new_state = np.zeros(len(self.state))
-        for k, v in new_frontier.items():
-            new_state[self.lookup[k.val]] = v
-        if new_state.sum() - 1. > 0.01:
-            breakpoint()
-        self.state = new_state
-        self.frontier = new_frontier
+            if self._order_idx is None:
+                raise KeyError(self._missing_key)
+            self._cur_idx = self._order_idx[(self.t+1)%self.num_nodes]
         self.t += 1
 
-    
+
     def get_state(self):
+        if not self.split and self._cur_idx is not None and self._shown_idx != self._cur_idx:
+            if self._shown_idx is not None:
+                self.state[self._shown_idx] = 0.
+            self.state[self._cur_idx] = 1.0
+            self._shown_idx = self._cur_idx
         return self.state
 
 
+def _child_id(c):
+    return c[0].id
+
+
+def _build_process(parg):
+    dag, lookup, diffusion_args = parg
+    return DiffusionProcess(dag, lookup, **diffusion_args)
+
+
 class DiffusionGraph:
     """
     This abstracts n simultaneous diffusion processes as one process on a single graph.
@@ -254,13 +380,51 @@ class DiffusionGraph:
         self.processes = []
 
         # account for all non-single-node dags
-        self.index_lookup = self.modify_graph(dags, graph)              
+        self.index_lookup = self.modify_graph(dags, graph)
         for dag in dags:
             if dag.id:
                 breakpoint()
-            self.processes.append(DiffusionProcess(dag, self.index_lookup, **diffusion_args))
+        # construction is embarrassingly parallel once the graph is modified
+        if len(dags) > 1 and (os.cpu_count() or 1) > 1:
+            with Pool(min(os.cpu_count(), len(dags))) as p:
+                self.processes = p.map(_build_process, [(dag, self.index_lookup, diffusion_args) for dag in dags])
+        else:
+            self.processes = [DiffusionProcess(dag, self.index_lookup, **diffusion_args) for dag in dags]
         self.graph = graph
         self.adj = nx.adjacency_matrix(graph).toarray()
+        self.adj_t = torch.from_numpy(self.adj).to(torch.bool) # shared mask for state_to_probs
+        self._init_batched_state()
+
+
+    def _init_batched_state(self):
+        """
+        keep all process states as rows of one (P, N) matrix; each process's
+        .state is a view into its row, so per-process consumers stay in sync
+        """
+        N = len(self.index_lookup)
+        self.states = np.zeros((len(self.processes), N))
+        for i, p in enumerate(self.processes):
+            self.states[i] = p.state
+            p.state = self.states[i]
+        self._split = any(p.split for p in self.processes)
+        if self._split:
+            # frozen (identity) blocks for processes whose groups are not on the graph
+            blocks = [p._T if p._T is not None else sp.identity(N, format='csr')
+                      for p in self.processes]
+            self._T_block = sp.block_diag(blocks, format='csr') if blocks else None
+        else:
+            valid = [i for i, p in enumerate(self.processes) if p._order_idx is not None]
+            self._valid_rows = np.array(valid, dtype=np.int64)
+            self._lens = np.array([self.processes[i].num_nodes for i in valid], dtype=np.int64)
+            max_len = self._lens.max() if valid else 1
+            self._tape = np.zeros((len(valid), max_len), dtype=np.int64)
+            for row, i in enumerate(valid):
+                self._tape[row, :self._lens[row]] = self.processes[i]._order_idx
+            self._cur = np.array([self.index_lookup[self.processes[i].dag.val] for i in valid], dtype=np.int64)
+            self._shown = self._cur
+            # rows of processes whose groups are off-graph never move
+            frozen = [i for i in range(len(self.processes)) if i not in set(valid)]
+            self._frozen_sum = self.states[frozen].sum(axis=0) if frozen else np.zeros(N)
 
 
     def lookup_process(self, dag_id):
@@ -316,38 +480,56 @@ class DiffusionGraph:
 
     def reset(self):
         self.t = 0
-        for p in self.processes:
+        for i, p in enumerate(self.processes):
             p.reset()
+            self.states[i] = p.state
+            p.state = self.states[i]
+        if not self._split:
+            self._cur = np.array([self.index_lookup[self.processes[i].dag.val] for i in self._valid_rows], dtype=np.int64)
+            self._shown = self._cur
 
     def step(self):
-        for p in self.processes:
-            try:
-                p.step()
-            except KeyError:
-                continue
+        if self._split:
+            if self._T_block is not None:
+                flat = self._T_block.dot(self.states.reshape(-1))
+                self.states = flat.reshape(self.states.shape)
+                for i, p in enumerate(self.processes):
+                    p.state = self.states[i]
+        elif len(self._valid_rows):
+            # just advance the tape cursors; one-hots are materialized on read
+            self._cur = self._tape[np.arange(len(self._valid_rows)), (self.t+1)%self._lens]
         self.t += 1
-    
+
     def get_state(self, return_all=False):
-        all_probs = [p.get_state() for (i, p) in enumerate(self.processes)]
+        if self._split or not len(self._valid_rows):
+            if return_all:
+                return self.states.copy()
+            probs = self.states.sum(axis=0, keepdims=True)
+            assert probs.shape[0] == 1
+            return probs/probs.sum()
         if return_all:
-            return np.array(all_probs)
-        probs = np.array(all_probs).sum(axis=0, keepdims=True)
-        assert probs.shape[0] == 1
+            self.states[self._valid_rows, self._shown] = 0.
+            self.states[self._valid_rows, self._cur] = 1.
+            self._shown = self._cur
+            return self.states.copy()
+        counts = np.bincount(self._cur, minlength=self.states.shape[1]).astype(float)
+        probs = (counts+self._frozen_sum)[None]
         return probs/probs.sum()
     
 
 class L_grammar(nn.Module):
-    def __init__(self, N, diff_args):
+    def __init__(self, N, diff_args, dtype=torch.float32):
         super().__init__()
         self.diff_args = diff_args
+        self.dtype = dtype
         if diff_args['e_init']:
-            E = torch.as_tensor(diff_args['init_e'], dtype=torch.float64)
+            E = torch.as_tensor(diff_args['init_e'], dtype=dtype)
         else:
-            E = torch.rand((N, N), dtype=torch.float64)
-        self.A = torch.as_tensor(diff_args['adj_matrix'], dtype=torch.float64)
+            E = torch.rand((N, N), dtype=dtype)
+        self.A = torch.as_tensor(diff_args['adj_matrix'], dtype=dtype)
         self.E = nn.Parameter(E)
-        self.scale = nn.Parameter(torch.ones((self.A.shape[0],), dtype=torch.float64))        
-        self.context_layer = nn.Linear(N, N*N, dtype=torch.float64)
+        self.scale = nn.Parameter(torch.ones((self.A.shape[0],), dtype=dtype))
+        self.context_layer = nn.Linear(N, N*N, dtype=dtype)
         nn.init.zeros_(self.context_layer.weight)
         nn.init.zeros_(self.context_layer.bias)
                  
@@ -355,24 +537,23 @@ class L_grammar(nn.Module):
     def forward(self, X, context, t):
         if self.diff_args['combine_walks']:
             L = torch.diag((self.E*self.A).sum(axis=0))-self.E # (N, N)
+            context = context*t/(t+1) + X/(t+1)
+            L_T = self.scale[None,...,None] * torch.transpose(L, -1,-2)
+            update = torch.matmul(X[...,None,:],L_T).squeeze() # sum to 0
+            return update, context
+        if self.diff_args['context_L']:
+            adjust = self.context_layer(context).reshape((-1,)+self.E.shape)
+            W_new = adjust + self.E # (M, N, N)
         else:
-            if self.diff_args['context_L']:
-                adjust = self.context_layer(context).reshape((-1,)+self.E.shape)
-                W_new = adjust + self.E # (M, N, N)
-            else:
-                W_new = self.E
-            # W_new is (M, N, N)
-            # self.A[None] is (1, N, N)
-            W_hat = torch.matmul(W_new,self.A[None]) # (M, N, N)
-            W_hat = W_hat.sum(axis=-2) # (M, N)
-            W_hat_diag = torch.diag_embed(W_hat) # (M, N, N)
-            L = W_hat_diag-W_new # (M, N, N)
-            L = L/L.sum(axis=-1, keepdim=True)
-        
-        context = context*t/(t+1) + X/(t+1)        
-        L_T = self.scale[None,...,None] * torch.transpose(L, -1,-2)
-        update = torch.matmul(X[...,None,:],L_T).squeeze() # sum to 0
-        return update, context
+            W_new = self.E
+        # L would be (diag_embed(W_hat)-W_new)/row_sums; instead of materializing
+        # it, expand X @ L^T into its diagonal and off-diagonal parts
+        W_hat = torch.matmul(W_new.sum(axis=-2), self.A) # (M, N)
+        row_sums = W_hat - W_new.sum(axis=-1) # (M, N)
+        context = context*t/(t+1) + X/(t+1)
+        X_s = X*self.scale
+        update = (X_s*W_hat - torch.matmul(W_new, X_s[...,None]).squeeze(-1))/row_sums
+        return update.squeeze(), context
     
 
 class Predictor(nn.Module):
@@ -411,11 +592,12 @@ class Predictor(nn.Module):
             act = nn.Sigmoid()
         else:
             raise
-        # assert input_dim == hidden_dim          
+        # assert input_dim == hidden_dim
+        # with shared params only one copy of each block exists, so don't
+        # even enter the loop body for the skipped heads
+        heads_to_build = [num_heads] if share_params else list(range(1, num_heads+1))
         if self.in_mlp:
-            for i in range(1, num_heads+1):
-                if share_params and i < num_heads:
-                    continue
+            for i in heads_to_build:
                 lin_out_1 = nn.Linear(input_dim, hidden_dim)
                 lin_out_2 = nn.Linear(hidden_dim, hidden_dim)
                 if self.dropout_rate:
@@ -438,9 +620,7 @@ class Predictor(nn.Module):
 
 
         if self.do_mlp_out:
-            for i in range(1, num_heads+1):
-                if share_params and i < num_heads:
-                    continue
+            for i in heads_to_build:
                 lin_out_1 = nn.Linear(hidden_dim, hidden_dim)
                 lin_out_2 = nn.Linear(hidden_dim, hidden_dim)
                 if self.dropout_rate:
@@ -462,10 +642,8 @@ class Predictor(nn.Module):
                 setattr(self, layer_name, mlp_out)
         
         if gnn == 'gin':
-            for j in range(1, num_heads+1):
+            for j in heads_to_build:
                 input_dim = hidden_dim if self.in_mlp else self.input_dim
-                if share_params and j < num_heads:
-                    continue                
                 for i in range(1, num_layers+1):
                     if i > 1: 
                         input_dim = hidden_dim     
@@ -498,10 +676,8 @@ class Predictor(nn.Module):
                     input_dim = hidden_dim if self.in_mlp else self.input_dim
                     setattr(self, f"gnn_conv_{j}", layer_name[gnn](input_dim, hidden_channels=hidden_dim, num_layers=num_layers, out_channels=hidden_dim))
         elif gnn in ['transformerconv', 'gpsconv']:
-            for j in range(1, num_heads+1):
+            for j in heads_to_build:
                 input_dim = hidden_dim if self.in_mlp else self.input_dim
-                if share_params and j < num_heads:
-                    continue
                 for i in range(1, num_layers+1):
                     if i > 1: 
                         input_dim = hidden_dim              
@@ -626,6 +802,17 @@ class Predictor(nn.Module):
             return out
     
 
+def compile_grammar(model):
+    """
+    best-effort torch.compile of L_grammar for inference-heavy paths
+    (walk_edge_weight over many DAGs); no-op on older torch
+    """
+    try:
+        return torch.compile(model, mode="reduce-overhead", fullgraph=True)
+    except Exception:
+        return model
+
+
 def state_to_probs(state, adj=None, softmax=False, uniform=False, softmax_temp=1.0):
     if softmax:
         state = F.softmax(state * softmax_temp, dim=-1)
@@ -634,68 +821,151 @@ def state_to_probs(state, adj=None, softmax=False, uniform=False, softmax_temp=1
     else:
         state = torch.where(state>=0., state, 0.0)
     if adj is not None:
-        state[:, adj==0.] = 0.
-    if state.sum(axis=-1) > 0:        
-        return state/state.sum(axis=-1)
-    else:
-        return state
-        # print(f"all probs 0")
-        # if adj is not None:
-        #     state[:, adj!=0.] = 1.
-        #     return state/state.sum(axis=-1)
-        # else:
-        #     breakpoint()
-    state = state - state.min(-1, True).values
-    return state/state.sum(axis=-1)
+        if not torch.is_tensor(adj):
+            adj = torch.as_tensor(adj)
+        state = state*(adj != 0.).to(state.dtype)
+    # branchless masked normalization: all-zero rows stay zero instead of
+    # triggering a data-dependent (and device-syncing) sum check
+    denom = state.sum(axis=-1, keepdim=True)
+    return state/denom.clamp(min=torch.finfo(state.dtype).tiny)
 
 
 def walk_edge_weight(dag, graph, model, proc, eps=1e-6, return_states=False, ablate_bidir=False):
     G = graph.graph
     N = len(graph.graph)
     all_nodes = list(G.nodes())
-    walk_order = []
     walk_order = proc.dfs_order
-    context = torch.zeros((1, N), dtype=torch.float64)
-    start_node_ind = graph.index_lookup[walk_order[0].val]
-    prev_node_ind = start_node_ind
+    dtype = getattr(model, 'dtype', torch.float32)
     W_adj = torch.zeros((N, N), dtype=torch.float32)
-    t = 0
-    state = torch.zeros((1, N), dtype=torch.float64)
-    state[0, start_node_ind] = 1.
-    traj = [str(start_node_ind)]
     if return_states:
+        # the per-step traj bookkeeping is inherently sequential, so keep the loop
+        context = torch.zeros((1, N), dtype=dtype)
+        start_node_ind = graph.index_lookup[walk_order[0].val]
+        prev_node_ind = start_node_ind
+        t = 0
+        state_buf = torch.zeros((1, N), dtype=dtype) # reused one-hot input buffer
+        state_buf[0, start_node_ind] = 1.
+        state = state_buf
+        traj = [str(start_node_ind)]
         states = [state.clone().detach().flatten().numpy()]
-    for j in range(1, len(walk_order)):
-        cur_node_ind = graph.index_lookup[walk_order[j%len(walk_order)].val]   
-        # print(f"input state {get_repr(state)}, context {get_repr(context)}, t {t}")               
-        update, context = model(state, context, t)                
-        state = state_to_probs(state+update, graph.adj[prev_node_ind])
-        if return_states:
+        for j in range(1, len(walk_order)):
+            cur_node_ind = graph.index_lookup[walk_order[j%len(walk_order)].val]
+            update, context = model(state, context, t)
+            state = state_to_probs(state+update, graph.adj_t[prev_node_ind])
             state_numpy = state.clone().detach().flatten().numpy()
-            for i in range(len(G)):
-                if len(traj) and extract(traj[-1]) == i: # can't loop back to itself if nothing else in between
-                    state_numpy[i] = 0.
-                if check_colon_order(all_nodes, traj, i):
-                    state_numpy[i] = 0. 
-            state_numpy = state_numpy/state_numpy.sum()            
+            state_numpy[colon_order_mask(all_nodes, traj)] = 0.
+            if len(traj): # can't loop back to itself if nothing else in between
+                state_numpy[extract(traj[-1])] = 0.
+            state_numpy = state_numpy/state_numpy.sum()
             states.append(state_numpy)
-        # print(f"post state {get_repr(state)}, context {get_repr(context)}, t {t}")  
-        # dist = Categorical(state)
-        # log_prob = dist.log_prob(cur_node_ind)
-        t += 1
-        W_adj[prev_node_ind, cur_node_ind] = max(state[0, cur_node_ind], eps)
-        if not ablate_bidir:
-            W_adj[cur_node_ind, prev_node_ind] = max(state[0, cur_node_ind], eps)
-        # print(f"recounted {cur_node_ind} with prob {state[0, cur_node_ind]}")        
-        state = torch.zeros((1, N), dtype=torch.float64)
-        state[0, cur_node_ind] = 1.
-        prev_node_ind = cur_node_ind  
-        append_traj(traj, cur_node_ind)
-    if return_states:
+            t += 1
+            W_adj[prev_node_ind, cur_node_ind] = max(state[0, cur_node_ind], eps)
+            if not ablate_bidir:
+                W_adj[cur_node_ind, prev_node_ind] = max(state[0, cur_node_ind], eps)
+            state_buf[0, prev_node_ind] = 0.
+            state_buf[0, cur_node_ind] = 1.
+            state = state_buf
+            prev_node_ind = cur_node_ind
+            append_traj(traj, cur_node_ind)
         return states, W_adj
+    # the only cross-step dependency is the context, and that is just a running
+    # mean of the one-hot inputs, so every model call can be batched into one
+    if getattr(proc, 'dfs_order_idx', None) is not None and proc.lookup is graph.index_lookup:
+        idx = proc.dfs_order_idx
     else:
-        return W_adj 
+        idx = np.array([graph.index_lookup[n.val] for n in walk_order], dtype=np.int64)
+    T = len(idx)-1
+    if T <= 0:
+        return W_adj
+    prev_t = torch.as_tensor(idx[:-1])
+    cur_t = torch.as_tensor(idx[1:])
+    states_b = torch.eye(N, dtype=dtype)[prev_t] # (T, N)
+    contexts = torch.zeros((T, N), dtype=dtype)
+    if T > 1:
+        contexts[1:] = torch.cumsum(states_b, 0)[:-1]/torch.arange(1, T, dtype=dtype)[:, None]
+    update, _ = model(states_b, contexts, 0)
+    probs = (states_b+update.reshape(T, N)).clamp(min=0.)
+    probs = probs*graph.adj_t[prev_t].to(dtype)
+    denom = probs.sum(-1, keepdim=True)
+    probs = probs/denom.clamp(min=torch.finfo(dtype).tiny)
+    p = probs[torch.arange(T), cur_t].clamp(min=eps)
+    for j in range(T):
+        W_adj[prev_t[j], cur_t[j]] = p[j]
+        if not ablate_bidir:
+            W_adj[cur_t[j], prev_t[j]] = p[j]
+    return W_adj
+
 
+@torch.inference_mode()
+def walk_edge_weights(dags, graph, model, procs, eps=1e-6, ablate_bidir=False):
+    """
+    batched walk_edge_weight: concatenate every dag's walk transitions into a
+    single model forward instead of one batch-1 call per dag, then split the
+    resulting probabilities back into per-dag W_adj matrices
+    """
+    N = len(graph.graph)
+    dtype = getattr(model, 'dtype', torch.float32)
+    idxs = []
+    for proc in procs:
+        if getattr(proc, 'dfs_order_idx', None) is not None and proc.lookup is graph.index_lookup:
+            idxs.append(proc.dfs_order_idx)
+        else:
+            idxs.append(np.array([graph.index_lookup[n.val] for n in proc.dfs_order], dtype=np.int64))
+    lens = [max(len(ix)-1, 0) for ix in idxs]
+    W_adjs = [torch.zeros((N, N), dtype=torch.float32) for _ in idxs]
+    total = sum(lens)
+    if total == 0:
+        return W_adjs
+    prev_t = torch.as_tensor(np.concatenate([ix[:-1] for ix in idxs if len(ix) > 1]))
+    cur_t = torch.as_tensor(np.concatenate([ix[1:] for ix in idxs if len(ix) > 1]))
+    states_b = torch.eye(N, dtype=dtype)[prev_t] # (total, N)
+    contexts = torch.zeros((total, N), dtype=dtype)
+    off = 0
+    for T in lens: # running mean of one-hots restarts per dag
+        if T > 1:
+            seg = states_b[off:off+T]
+            contexts[off+1:off+T] = torch.cumsum(seg, 0)[:-1]/torch.arange(1, T, dtype=dtype)[:, None]
+        off += T
+    update, _ = model(states_b, contexts, 0)
+    probs = (states_b+update.reshape(total, N)).clamp(min=0.)
+    probs = probs*graph.adj_t[prev_t].to(dtype)
+    denom = probs.sum(-1, keepdim=True)
+    probs = probs/denom.clamp(min=torch.finfo(dtype).tiny)
+    p = probs[torch.arange(total), cur_t].clamp(min=eps)
+    off = 0
+    for W_adj, T in zip(W_adjs, lens):
+        for j in range(off, off+T):
+            W_adj[prev_t[j], cur_t[j]] = p[j]
+            if not ablate_bidir:
+                W_adj[cur_t[j], prev_t[j]] = p[j]
+        off += T
+    return W_adjs
+
+
+
+@lru_cache(maxsize=200000)
+def _parse_smi(s):
+    return Chem.MolFromSmiles(s)
+
+
+@lru_cache(maxsize=200000)
+def _parse_sma(s):
+    return Chem.MolFromSmarts(s)
+
+
+@lru_cache(maxsize=None)
+def _smiles_to_fp(smiles):
+    """SMILES -> 2048-d fingerprint tensor, cached since dags repeat across calls."""
+    mol = _parse_smi(smiles)
+    if mol is None: # try smarts
+        mol = _parse_sma(smiles)
+    else:
+        mol = Chem.AddHs(mol)
+    try:
+        Chem.SanitizeMol(mol)
+        return torch.as_tensor(mol2fp(mol), dtype=torch.float32)
+    except:
+        return torch.zeros((2048,), dtype=torch.float32)
 
 
 def featurize_walk(args, graph, model, dag, proc, mol_feats, feat_lookup={}, vis=False):
@@ -723,31 +993,17 @@ def featurize_walk(args, graph, model, dag, proc, mol_feats, feat_lookup={}, vis
         assert len(proc.dfs_order) == 1
         N = len(graph.graph)
         W_adj = torch.zeros((N, N), dtype=torch.float32)                
-        if isinstance(feat_lookup[dag.val], torch.Tensor):
-            feat = feat_lookup[dag.val][None]
-            mol_isolated_feats = torch.tile(feat,[N,1])
-        else:
-            feat = feat_lookup[dag.val][None].astype('float32')
-            mol_isolated_feats = np.tile(feat,[N,1])
+        feat = feat_lookup[dag.val]
+        if not isinstance(feat, torch.Tensor):
+            feat = torch.as_tensor(feat.astype('float32'))
+        mol_isolated_feats = feat[None].expand(N, -1) # broadcast view, no N copies
         node_attr, edge_index, edge_attr = W_to_attr(args, W_adj, mol_isolated_feats)
         assert edge_index.shape[1] == 0
         edge_index = torch.tensor([[0], [0]], dtype=torch.int64) # trivial self-connection for gnn
         edge_attr = torch.tensor([[1.]])
-    if hasattr(dag, 'smiles') and args.concat_mol_feats:        
-        dag_mol = Chem.MolFromSmiles(dag.smiles)
-        if dag_mol is None: # try smarts
-            dag_mol = Chem.MolFromSmarts(dag.smiles)        
-        else:
-            dag_mol = Chem.AddHs(dag_mol)  
-        try:
-            Chem.SanitizeMol(dag_mol)          
-            if dag_mol is None:
-                breakpoint()
-            smiles_fp = torch.as_tensor(mol2fp(dag_mol), dtype=torch.float32)
-        except:
-            smiles_fp = torch.zeros((2048,), dtype=torch.float32)        
-        smiles_fp = torch.as_tensor(mol2fp(dag_mol), dtype=torch.float32)
-        node_attr = torch.concat((node_attr, torch.tile(smiles_fp, (node_attr.shape[0],1))), -1)
+    if hasattr(dag, 'smiles') and args.concat_mol_feats:
+        smiles_fp = _smiles_to_fp(dag.smiles)
+        node_attr = torch.concat((node_attr, smiles_fp.expand(node_attr.shape[0], -1)), -1)
     return node_attr, edge_index, edge_attr
         
 
@@ -758,8 +1014,10 @@ def diffuse(graph, log_folder, **diff_args):
     print(f"state at 0: {graph.get_state()}")    
     N, M = len(G), 1 if diff_args['combine_walks'] else len(graph.processes)
     if diff_args['e_init']:
-        diff_args['init_e'] = nx.adjacency_matrix(G).toarray()
+        diff_args['init_e'] = graph.adj
     model = L_grammar(N, diff_args)
+    if diff_args.get('compile'):
+        model = compile_grammar(model)
     # if diff_args['e_init']:
     #     E = torch.as_tensor(nx.adjacency_matrix(G).toarray(), dtype=torch.float64)
     # else:
@@ -781,16 +1039,27 @@ def diffuse(graph, log_folder, **diff_args):
     history = []
     T = 10
     best_loss = float("inf")
+    loss_func = nn.MSELoss()
+    fig = plt.Figure()
+    ax = fig.add_subplot(1,1,1)
+    line, = ax.plot([], [])
+    ax.set_title(f"Loss over {diff_args['num_epochs']} epochs, {T} steps each")
+    ax.set_ylabel(f"MSE Loss of X^t")
+    ax.set_yscale('log')
+    ax.set_xlabel('(Epoch, t)')
+    plot_file = os.path.join(log_folder, 'L_loss.png')
+    plot_every = max(1, diff_args['num_epochs']//50)
+    best_line = ax.axhline(y=1., color='red')
+    best_text = ax.text(0, 1., "")
     for i in range(diff_args['num_epochs']):
         graph.reset()
-        context = torch.zeros((M, N), dtype=torch.float64)
-        loss_func = nn.MSELoss()    
+        context = torch.zeros((M, N), dtype=model.dtype)
         t_losses = []
-        for t in range(T):            
-            opt.zero_grad()     
-            X = torch.as_tensor(graph.get_state(not diff_args['combine_walks'])) # (M, N)
+        for t in range(T):
+            opt.zero_grad()
+            X = torch.as_tensor(graph.get_state(not diff_args['combine_walks']), dtype=model.dtype) # (M, N)
             graph.step()
-            Y = torch.as_tensor(graph.get_state(not diff_args['combine_walks'])) # (M, N)                      
+            Y = torch.as_tensor(graph.get_state(not diff_args['combine_walks']), dtype=model.dtype) # (M, N)
             update, context = model(X, context, t)
             loss = loss_func(X+update, Y) # (1,N)+(1,N)(N,N) or (M,N)+(M,1,N)(M,N,N)        
             t_losses.append(loss.item())
@@ -800,38 +1069,35 @@ def diffuse(graph, log_folder, **diff_args):
 
         print(f"epoch {i} loss: {np.mean(t_losses)}")
         history.append(np.mean(t_losses))
-        
-        fig = plt.Figure()
-        ax = fig.add_subplot(1,1,1)
-        ax.plot(history)
-        ax.text(0, min(history), "{}".format(min(history)))
-        ax.axhline(y=min(history), color='red')
-        ax.set_title(f"Loss over {diff_args['num_epochs']} epochs, {T} steps each")
-        ax.set_ylabel(f"MSE Loss of X^t")
-        ax.set_yscale('log')
-        ax.set_xlabel('(Epoch, t)')
-        plot_file = os.path.join(log_folder, 'L_loss.png')
-        fig.savefig(plot_file)
-        print(plot_file)
+
+        if (i+1) % plot_every == 0 or i+1 == diff_args['num_epochs']:
+            line.set_data(range(len(history)), history)
+            best_line.set_ydata([min(history)]*2)
+            best_text.set_position((0, min(history)))
+            best_text.set_text("{}".format(min(history)))
+            ax.relim()
+            ax.autoscale_view()
+            fig.savefig(plot_file)
+            print(plot_file)
 
         if np.mean(t_losses) < best_loss:
             print(f"E mean: {model.E.mean()}, std: {model.E.std()}")
             best_loss = np.mean(t_losses)
             torch.save(model.state_dict(), os.path.join(log_folder, 'ckpt.pt'))
+    plt.close(fig)
     return model
 
 
 def side_chain_grammar(index_lookup, log_folder):
     X = [] ; y = []
     history = []
-    drop_colon = lambda x: x.split(':')[0]
     for dag in dags:
         chain = DiffusionProcess.compute_main_chain(dag)
-        hot = torch.LongTensor([index_lookup[drop_colon(n.val)] for n in chain])
+        hot = torch.LongTensor([index_lookup[n.short_val] for n in chain])
         walk = F.one_hot(hot, num_classes=num_nodes).sum(axis=0, keepdims=True)
         layer = nn.Linear(2*num_nodes, 2)
         for n in chain:
-            cur = torch.LongTensor([index_lookup[drop_colon(n.val)]])
+            cur = torch.LongTensor([index_lookup[n.short_val]])
             walk_cur = torch.cat((F.normalize(walk+0.0), F.one_hot(cur, num_classes=num_nodes)+0.0), dim=-1)
             X.append(walk_cur)
             side_chain = 0
@@ -883,24 +1149,37 @@ def process_good_traj(traj, all_nodes):
     turn it into ['L3','S32','S20[->P14->P39,->S18]','S32']
     simple string parsing algo is enough
     """
-    name_traj = []
-    for x in traj:
-        i = 0
-        y = ""
-        while i < len(x):
-            if x[i].isdigit():
-                j = i+1
-                while j < len(x):
-                    if not x[j].isdigit():
-                        break
-                    j += 1
-                y += all_nodes[int(x[i:j])]
-                i = j
-            else:
-                y += x[i]
-                i += 1
-        name_traj.append(y)
-    return name_traj
+    return list(_process_good_traj(tuple(traj), tuple(all_nodes)))
+
+
+_DIGIT_RE = re.compile(r'\d+')
+
+
+@lru_cache(maxsize=65536)
+def _process_good_traj(traj, all_nodes):
+    return tuple(_DIGIT_RE.sub(lambda m: all_nodes[int(m.group(0))], x) for x in traj)
+
+
+_verify_fail_cache = {}
+def _verify_cached(r_lookup, G, name_traj, **kwargs):
+    """Memoize verify_walk failures so invalid subtrees short-circuit on revisit.
+
+    Successes are recomputed each time: the returned dag is mutated downstream
+    (value_count, seen_dags), so it cannot be shared across calls.
+    """
+    key = (tuple(name_traj), tuple(sorted(kwargs.items())))
+    hit = _verify_fail_cache.get(key)
+    if hit is not None:
+        # raise a fresh instance: re-raising a stored exception grows its
+        # __traceback__ chain (and pins the referenced frames) on every hit
+        exc_type, exc_args = hit
+        raise exc_type(*exc_args)
+    try:
+        return verify_walk(r_lookup, G, name_traj, **kwargs)
+    except Exception as e:
+        if len(_verify_fail_cache) < 65536:
+            _verify_fail_cache[key] = (type(e), e.args)
+        raise
 
 
 # after indicates side chain, e.g. A, B, A good but A, B, C, A bad
@@ -913,25 +1192,73 @@ def extract_sides(x):
     return occur
 
 
+@lru_cache(maxsize=None)
+def _parse_node(name):
+    # 'P3:2' -> ('P3', 2); 'P3' -> ('P3', 0)
+    grp, _, ind = name.partition(':')
+    return grp, int(ind) if ind else 0
+
+
+@lru_cache(maxsize=4)
+def _colon_order_data(all_nodes_t):
+    """
+    static per-graph arrays for the colon-order checks: revisit indices,
+    the (substring) group-containment columns for revisit nodes, and each
+    revisit node's predecessor variant
+    """
+    N = len(all_nodes_t)
+    parsed = [_parse_node(n) for n in all_nodes_t]
+    idx_of = np.array([ind for _, ind in parsed], dtype=np.int64)
+    contain = np.zeros((N, N), dtype=bool)
+    for j, name in enumerate(all_nodes_t):
+        if idx_of[j]:
+            for i in range(N):
+                contain[i, j] = parsed[i][0] in name
+    name_to_i = dict(zip(all_nodes_t, range(N)))
+    prev_var = np.full(N, -1, dtype=np.int64)
+    for i, (grp, ind) in enumerate(parsed):
+        if ind:
+            prev_var[i] = name_to_i.get(grp+(f':{ind-1}' if ind > 1 else ''), -1)
+    colon_nodes = tuple(sorted((i for i in range(N) if idx_of[i]), key=lambda i: idx_of[i]))
+    return idx_of, contain, prev_var, colon_nodes
+
+
+def colon_order_mask(all_nodes, traj):
+    """
+    boolean mask over all_nodes that is True wherever check_colon_order would
+    reject the node, computed once per step instead of once per candidate
+    """
+    idx_of, contain, prev_var, colon_nodes = _colon_order_data(tuple(all_nodes))
+    N = len(all_nodes)
+    heads = set(extract(x) for x in traj)
+    present = np.zeros(N, dtype=bool)
+    present[list(heads)] = True
+    bad = np.zeros(N, dtype=bool)
+    for j in heads:
+        if idx_of[j]: # P3:4 seen but we get P3:3
+            bad |= contain[:, j] & (idx_of < idx_of[j])
+    ok = np.ones(N, dtype=bool)
+    for i in colon_nodes: # we get P3:3 but no P3:2 seen
+        pv = prev_var[i]
+        ok[i] = pv >= 0 and present[pv] and ok[pv]
+    return bad | ~ok
+
+
 def check_colon_order(all_nodes, traj, after):
     """
     For example, what if we have G2->G2:1->G2:1?
     Or G2->G2? These are both cases of bad colon order, and should be avoided by design.
-    """   
-    if ':' in all_nodes[after]:
-        ind = int(all_nodes[after].split(':')[-1])
-    else:
-        ind = 0
+    """
+    grp, ind = _parse_node(all_nodes[after])
     bad_ind = False
-    grp = all_nodes[after].split(':')[0]
     prev_indices = [all_nodes[extract(x)] for x in traj if grp in all_nodes[extract(x)]]
     for prev_ind in prev_indices:
-        if ':' in prev_ind and int(prev_ind.split(':')[-1]) > ind:
+        if _parse_node(prev_ind)[1] > ind:
             bad_ind = True # P3:4 seen but we get 'P3:3'
     for i in range(ind-1, -1, -1):
         prev_ind_str = grp+(':'+str(i) if i else '')
         if prev_ind_str not in prev_indices:
-            bad_ind = True # we get P3:3 but no P3:2 seen    
+            bad_ind = True # we get P3:3 but no P3:2 seen
     return bad_ind
 
 
@@ -947,7 +1274,8 @@ def get_repr(state):
 
 
 def append_traj(traj, after):
-    # convert traj=['P21[->L3,->S20]', 'P20'] into ['P21', 'L3', 'S20', 'P20']    
+    # convert traj=['P21[->L3,->S20]', 'P20'] into ['P21', 'L3', 'S20', 'P20']
+    after_str = str(after)
     occur = []
     for x in traj:
         if '[' in x:
@@ -955,14 +1283,14 @@ def append_traj(traj, after):
         else:
             occur.append(x)
 
-    occur = np.array([str(after) in x for x in occur])
-    
+    occur_count = sum(1 for x in occur if after_str in x)
+
     # convert L3, S21, L3 into L3[->S21]
     # convert L3[->P28,->S20], S21, L3 into L3[->P28,->S20,->S21]
-    if occur.sum():
-        if len(occur) == 1 or occur.sum() != 1: 
-            return []    
-        if len(traj) < 2 or str(after) != traj[-2].split('[')[0]: 
+    if occur_count:
+        if len(occur) == 1 or occur_count != 1:
+            return []
+        if len(traj) < 2 or after_str != traj[-2].split('[')[0]:
             return []
         # len(traj) >= 2 and after is head of traj[-2]
 
@@ -998,34 +1326,43 @@ def append_traj(traj, after):
         traj.pop(-1)
         # print("after", traj, after)
     else:
-        traj.append(str(after))    
+        traj.append(after_str)
     return traj
 
 
 
+def set_onehot(buf, idx, prev_idx=None):
+    """Reuse buf as a one-hot by clearing only the previously-set entry."""
+    if prev_idx is not None:
+        buf[0, prev_idx] = 0.
+    buf[0, idx] = 1.
+    return buf
+
+
+@torch.inference_mode()
 def sample_walk(n, G, graph, model, all_nodes, loop_back=True, min_thresh=0.0, softmax=False):
-    N = len(G)     
-    context = torch.zeros((1, N), dtype=torch.float64)
+    N = len(G)
+    context = torch.zeros((1, N), dtype=torch.float32)
     start = graph.index_lookup[n]
-    state = torch.zeros((1, len(G)), dtype=torch.float64)
-    state[0, graph.index_lookup[n]] = 1.
+    onehot_buf = torch.zeros((1, len(G)), dtype=torch.float32)
+    state = set_onehot(onehot_buf, start)
+    prev_idx = start
     traj = [str(start)]
-    cur_node_ind = start    
+    cur_node_ind = start # always extract(traj[-1])
     t = 0
     after = -1
     good = False      
     while True:      
         # print(f"input state {get_repr(state)}, context {get_repr(context)}, t {t}")  
         update, context = model(state, context, t)
-        if not (state>=0).all():
-            breakpoint()                         
+        if __debug__ and _debug_checks and state.min().item() < 0:
+            raise ValueError("negative state probabilities")
         state = state_to_probs(state+update, graph.adj[cur_node_ind], softmax=softmax)
-        state_numpy = state.detach().flatten().numpy()
-        for i in range(len(G)):
-            if len(traj) and extract(traj[-1]) == i: # can't loop back to itself if nothing else in between
-                state_numpy[i] = 0.
-            if check_colon_order(all_nodes, traj, i):
-                state_numpy[i] = 0.
+        state_numpy = state.flatten().numpy()
+        state_numpy[colon_order_mask(all_nodes, traj)] = 0.
+        state_numpy[cur_node_ind] = 0. # can't loop back to itself if nothing else in between
+        # renormalize in fp64 so the cumsum used for sampling ends exactly at 1
+        state_numpy = state_numpy.astype(np.float64)
         state_numpy = state_numpy/state_numpy.sum()
         if not (state_numpy==state_numpy).all() or state_numpy.max() <= min_thresh: # set a threshold >= 0.
             if not loop_back:
@@ -1038,7 +1375,9 @@ def sample_walk(n, G, graph, model, all_nodes, loop_back=True, min_thresh=0.0, s
         # inds = np.argwhere(state_numpy>min_thresh)
         # state_numpy = state_numpy[state_numpy>min_thresh]
         # state_numpy = state_numpy/state_numpy.sum()
-        after = np.random.choice(N, p=state_numpy)
+        # inverse-CDF sampling; cheaper than np.random.choice's p validation
+        cdf = np.cumsum(state_numpy)
+        after = int(np.searchsorted(cdf, np.random.random()*cdf[-1]))
 
         # after = np.random.choice(len(state_numpy), p=state_numpy)                
         # try:
@@ -1046,11 +1385,11 @@ def sample_walk(n, G, graph, model, all_nodes, loop_back=True, min_thresh=0.0, s
         #     print(f"sampled {after} with prob {state_numpy[after]}")
         # except:
         #     breakpoint()                    
-        state = torch.zeros((1, len(G)), dtype=torch.float64)
-        state[0, after] = 1.
+        state = set_onehot(onehot_buf, after, prev_idx)
+        prev_idx = after
 
         # self-loop, not allowed!
-        if extract(traj[-1]) == after:
+        if cur_node_ind == after:
             traj.append(str(after))
             break
         
@@ -1073,7 +1412,7 @@ def sample_walk(n, G, graph, model, all_nodes, loop_back=True, min_thresh=0.0, s
 
 
 def get_state(G, start, after, traj, loop_back):                  
-    state = torch.zeros((1, len(G)), dtype=torch.float64)
+    state = torch.zeros((1, len(G)), dtype=torch.float32)
     state[0, after] = 1.
 
     # self-loop, not allowed!
@@ -1098,53 +1437,48 @@ def get_state(G, start, after, traj, loop_back):
 class PriorityQueue(object):
     def __init__(self):
         self.queue = []
- 
+        self._counter = count() # FIFO tie-break, and items never compared
+
     def __str__(self):
         return ' '.join([str(i) for i in self.queue])
- 
+
     # for checking if the queue is empty
     def isEmpty(self):
         return len(self.queue) == 0
- 
-    # for inserting an element in the queue
+
+    # for inserting an element in the queue; priority is computed once here
     def insert(self, data):
-        self.queue.append(data)
+        heapq.heappush(self.queue, (-PriorityQueue.priority(data), next(self._counter), data))
 
     @staticmethod
     def priority(tup): # sum(log(prob))
         dic = tup[-1]
         if dic:
-            log_prob = 0.0
-            for prob in dic.values():
-                log_prob += np.log(prob)
-            return log_prob
+            return fsum(log(prob) for prob in dic.values())
         else:
             return 0.0
- 
-    # for popping an element based on Priority
+
+    # for popping the max-priority element
     def delete(self):
         try:
-            max_val = 0
-            pr = 0
-            for i in range(len(self.queue)):
-                if PriorityQueue.priority(self.queue[i]) > PriorityQueue.priority(self.queue[max_val]):
-                    max_val = i
-                    pr = PriorityQueue.priority(self.queue[i])
-            item = self.queue[max_val]
-            del self.queue[max_val]
-            print(f"returning item with priority {pr}")
+            neg_pr, _, item = heapq.heappop(self.queue)
+            print(f"returning item with priority {-neg_pr}")
             return item
         except IndexError:
             print()
             exit()
 
 
+@torch.inference_mode()
 def extract_rule(n, G, graph, model, all_nodes, loop_back=True, max_thresh=0.95, min_thresh=0.1, depth=2, r_lookup=None, num_generate=float("inf")):
+    # depth=-1 runs the best-first generator; a positive depth is the max
+    # rule depth, and one traversal emits (d, prefix, rule, probs) tuples
+    # for every d in 2..depth-1 off the shared prefix
     def initialize(n):
         N = len(G)     
-        context = torch.zeros((1, N), dtype=torch.float64)
+        context = torch.zeros((1, N), dtype=torch.float32)
         start = graph.index_lookup[n]
-        state = torch.zeros((1, len(G)), dtype=torch.float64)
+        state = torch.zeros((1, len(G)), dtype=torch.float32)
         state[0, graph.index_lookup[n]] = 1.
         traj = [str(start)]
         t = 0         
@@ -1157,99 +1491,115 @@ def extract_rule(n, G, graph, model, all_nodes, loop_back=True, max_thresh=0.95,
         else:
             explore.insert(initialize(n))
     else:
-        explore.append(initialize(n))
+        explore = [initialize(n)]
     trajs = []
-    while not explore.isEmpty():
+    def queue_empty():
+        return explore.isEmpty() if depth == -1 else not explore
+    def queue_len():
+        return len(explore.queue) if depth == -1 else len(explore)
+    def pop_item():
+        return explore.delete() if depth == -1 else explore.pop(-1)
+    def peek_t():
+        return explore.queue[0][-1][3] if depth == -1 else explore[-1][3]
+    while not queue_empty():
         if len(trajs) == num_generate:
             break
-        # print(f"input state {get_repr(state)}, context {get_repr(context)}, t {t}")
-        print(f"{len(explore.queue)} in the priority queue, {len(trajs)} done")
-        if depth == -1:
-            traj, state, context, t, probs = explore.delete()
-        else:
-            traj, state, context, t, probs = explore.pop(-1)       
-        start = int(traj[0].split('[')[0])
-        cur_node_ind = state[0].argmax().item()
-        update, context = model(state, context, t)
-        t += 1
-        if not (state>=0).all():
-            breakpoint()
-        state = state_to_probs(state+update, graph.adj[cur_node_ind])
-        state_numpy = state.detach().flatten().numpy()
-        for i in range(len(G)):
-            if len(traj) and extract(traj[-1]) == i: # can't loop back to itself if nothing else in between
-                state_numpy[i] = 0.
-            if check_colon_order(all_nodes, traj, i):
-                state_numpy[i] = 0.                                                   
-        state_numpy = state_numpy/state_numpy.sum()        
-        if not (state_numpy == state_numpy).all():
-            continue
-        if depth == -1:
-            inds = state_numpy.nonzero()[0]            
-            for ind in inds:
-                ind_traj = deepcopy(traj)  
-                state = get_state(G, start, ind, ind_traj, loop_back=True) # group contrib
-                if traj == ind_traj: # means violation
-                    continue                
-                # try to verify                    
-                named_ind_traj = process_good_traj(ind_traj, all_nodes)
-                done = (str(start) == ind_traj[-1])                
-                try:
-                    root, conn = verify_walk(r_lookup, G, named_ind_traj, loop_back=done)
-                except Exception as e:                        
-                    continue
-                ind_probs = deepcopy(probs)
-                ind_probs[f"{all_nodes[cur_node_ind]}-{all_nodes[ind]}"] = state_numpy[ind]                                   
-                if state is None:
-                    if not done:
-                        breakpoint()
-                    trajs.append((ind_traj, root, ind_probs))                    
-                else:                                                                                         
-                    explore.insert((ind_traj, state, context.clone(), t, ind_probs))
-        else:
-            if depth-1 == t:
-                if state_numpy.max() < max_thresh:
-                    break
-                else:
+        print(f"{queue_len()} in the priority queue, {len(trajs)} done")
+        # drain frontier items sharing the same t into one batched forward
+        batch = [pop_item()]
+        t = batch[0][3]
+        while len(batch) < 64 and not queue_empty() and peek_t() == t:
+            batch.append(pop_item())
+        states_b = torch.cat([item[1] for item in batch], 0)
+        contexts_b = torch.cat([item[2] for item in batch], 0)
+        updates, _ = model(states_b, contexts_b, t)
+        updates = updates.reshape(len(batch), -1)
+        new_contexts = contexts_b*t/(t+1) + states_b/(t+1)
+        for bi, (traj, state, context, _, probs) in enumerate(batch):
+            start = int(traj[0].split('[')[0])
+            cur_node_ind = state[0].argmax().item()
+            context = new_contexts[bi:bi+1]
+            t1 = t+1
+            if __debug__ and _debug_checks and state.min().item() < 0:
+                raise ValueError("negative state probabilities")
+            state = state_to_probs(state+updates[bi:bi+1], graph.adj[cur_node_ind])
+            state_numpy = state.flatten().numpy()
+            state_numpy[colon_order_mask(all_nodes, traj)] = 0.
+            if len(traj): # can't loop back to itself if nothing else in between
+                state_numpy[extract(traj[-1])] = 0.
+            state_numpy = state_numpy/state_numpy.sum()
+            if not (state_numpy == state_numpy).all():
+                continue
+            if depth == -1:
+                inds = state_numpy.nonzero()[0]
+                for ind in inds:
+                    ind_traj = list(traj)
+                    state = get_state(G, start, ind, ind_traj, loop_back=True) # group contrib
+                    if traj == ind_traj: # means violation
+                        continue
+                    # try to verify
+                    named_ind_traj = process_good_traj(ind_traj, all_nodes)
+                    done = (str(start) == ind_traj[-1])
+                    try:
+                        root, conn = _verify_cached(r_lookup, G, named_ind_traj, loop_back=done)
+                    except Exception as e:
+                        continue
+                    ind_probs = probs.copy()
+                    ind_probs[f"{all_nodes[cur_node_ind]}-{all_nodes[ind]}"] = float(state_numpy[ind])
+                    if state is None:
+                        if not done:
+                            breakpoint()
+                        trajs.append((ind_traj, root, ind_probs))
+                    else:
+                        explore.insert((ind_traj, state, context.clone(), t1, ind_probs))
+            else:
+                # one traversal serves every rule depth: an item popped at
+                # time t records a depth t+2 rule when its argmax clears
+                # max_thresh, and its min_thresh children extend the shared
+                # prefix towards the deeper depths
+                d = t1+1
+                if d <= depth-1 and state_numpy.max() >= max_thresh:
                     ind = state_numpy.argmax()
-                    traj = deepcopy(traj)
                     if start == 303 and ind == 0:
                         breakpoint()
-                    traj_copy = deepcopy(traj)
-                    probs_copy = deepcopy(probs)
-                    _ = get_state(G, start, ind, traj, loop_back=loop_back)                
-                    if traj_copy == traj:
-                        continue
-                    prob = state_numpy.max()
-                    print(f"found depth={depth} rule {traj} with prob={prob}")
-                    probs_copy[f"{all_nodes[cur_node_ind]}-{all_nodes[ind]}"] = prob
-                    trajs.append((traj_copy, traj, probs_copy))
-            else:
-                inds = np.arange(len(state_numpy))
-                for ind in inds[state_numpy >= min_thresh]:
-                    ind_traj = deepcopy(traj)
-                    state = get_state(G, start, ind, ind_traj, loop_back=loop_back)
-                    if traj == ind_traj:
-                        continue
-                    if state is not None:
-                        ind_probs = deepcopy(probs)
-                        ind_probs[f"{all_nodes[cur_node_ind]}-{all_nodes[ind]}"] = state_numpy[ind]
-                        explore.append((ind_traj, state, context.clone(), t, ind_probs))        
+                    traj_copy = list(traj)
+                    probs_copy = probs.copy()
+                    ext_traj = list(traj)
+                    _ = get_state(G, start, ind, ext_traj, loop_back=loop_back)
+                    if traj_copy != ext_traj:
+                        prob = state_numpy.max()
+                        print(f"found depth={d} rule {ext_traj} with prob={prob}")
+                        probs_copy[f"{all_nodes[cur_node_ind]}-{all_nodes[ind]}"] = float(prob)
+                        trajs.append((d, traj_copy, ext_traj, probs_copy))
+                if d <= depth-2:
+                    inds = np.arange(len(state_numpy))
+                    for ind in inds[state_numpy >= min_thresh]:
+                        ind_traj = list(traj)
+                        state = get_state(G, start, ind, ind_traj, loop_back=loop_back)
+                        if traj == ind_traj:
+                            continue
+                        if state is not None:
+                            ind_probs = probs.copy()
+                            ind_probs[f"{all_nodes[cur_node_ind]}-{all_nodes[ind]}"] = float(state_numpy[ind])
+                            explore.append((ind_traj, state, context.clone(), t1, ind_probs))
     return trajs
 
 
 def do_predict(predictor, X, edge_index, edge_attr, batch=None, cuda=-1, return_feats=False):
     if cuda > -1:
-        X, edge_index, edge_attr = X.to(f"cuda:{cuda}"), edge_index.to(f"cuda:{cuda}"), edge_attr.to(f"cuda:{cuda}")
+        X = X.to(f"cuda:{cuda}", non_blocking=True)
+        edge_index = edge_index.to(f"cuda:{cuda}", non_blocking=True)
+        edge_attr = edge_attr.to(f"cuda:{cuda}", non_blocking=True)
     # try modifying X based on edge_attr
     if return_feats:
-        out, feats = predictor(X, edge_index, edge_attr, return_feats=return_feats)
+        y_hat, feats = predictor(X, edge_index, edge_attr, return_feats=return_feats)
         if batch:
             breakpoint()
         else:
             node_mask = torch.unique(edge_index)
             feats = feats[node_mask] if predictor.share_params else [h[node_mask] for h in feats]
-    y_hat = predictor(X, edge_index, edge_attr)
+    else:
+        y_hat = predictor(X, edge_index, edge_attr)
     if batch is None:
         node_mask = torch.unique(edge_index)
         y_hat = y_hat[node_mask]        
@@ -1267,8 +1617,15 @@ def do_predict(predictor, X, edge_index, edge_attr, batch=None, cuda=-1, return_
 
 
 def W_to_attr(args, W_adj, mol_feats):
-    edge_index = W_adj.nonzero().T
-    edge_attr = W_adj.flatten()[W_adj.flatten()>0][:, None]    
+    if W_adj.is_sparse:
+        W_adj = W_adj.coalesce()
+        edge_index = W_adj.indices()
+        edge_attr = W_adj.values()[:, None].contiguous()
+        W_adj = W_adj.to_dense()
+    else:
+        mask = W_adj > 0
+        edge_index = mask.nonzero().T
+        edge_attr = W_adj[mask][:, None].contiguous()
     if args.mol_feat == 'W':
         node_attr = W_adj
     else:
@@ -1279,9 +1636,26 @@ def W_to_attr(args, W_adj, mol_feats):
 
 
 
-def sample_walks(args, 
-                 G, 
-                 graph, 
+# fixed sample_walk arguments, installed once per worker by the pool
+# initializer so only the (start node, seed) pair travels per task
+_walk_worker_state = {}
+
+
+def _init_walk_worker(model, G, graph, all_nodes, sample_args):
+    _walk_worker_state.update(model=model, G=G, graph=graph,
+                              all_nodes=all_nodes, sample_args=sample_args)
+
+
+def _sample_walk_shard(parg):
+    n, seed = parg
+    np.random.seed(seed)
+    s = _walk_worker_state
+    return sample_walk(n, s['G'], s['graph'], s['model'], s['all_nodes'], **s['sample_args'])
+
+
+def sample_walks(args,
+                 G,
+                 graph,
                  seen_dags, 
                  model, 
                  all_nodes, 
@@ -1309,8 +1683,9 @@ def sample_walks(args,
         predictor = predict_args['predictor']
         mol_feats = predict_args['mol_feats']
         feat_lookup = predict_args['feat_lookup']
-    if not (nx.adjacency_matrix(G).toarray() == graph.adj).all():
-        breakpoint()
+    if __debug__ and getattr(args, 'debug_adj', False):
+        if not (nx.adjacency_matrix(G).toarray() == graph.adj).all():
+            breakpoint()
     if hasattr(args, 'all_dags_path') and args.all_dags_path:
         all_dags = json.load(open(args.all_dags_path))
         novel = all_dags['novel']       
@@ -1337,6 +1712,7 @@ def sample_walks(args,
                 g.add_edge(dest, src, r_grp_1=e_dest['r_grp_1'], b1=e_dest['b1'], r_grp_2=e_dest['r_grp_2'], b2=e_dest['b2'])
             breakpoint()
     
+    model.eval()
     test_walks = hasattr(args, 'test_walks_file') and args.test_walks_file
     if test_walks:
         if '.txt' in args.test_walks_file:
@@ -1348,11 +1724,22 @@ def sample_walks(args,
             raise NotImplementedError
         setattr(args, 'num_generate_samples', len(eval_trajs))
         test_index = 0
-    while new_novel < args.num_generate_samples:                    
-        n = list(G.nodes())[index%len(G)]
+    base_nodes = [n for n in G.nodes() if ':' not in n] # constant across the run
+    sample_args = dict(loop_back='group-contrib' in os.environ['dataset'],
+                       min_thresh=args.min_thresh,
+                       softmax=args.softmax)
+    num_workers = getattr(args, 'sample_workers', 0)
+    pool = None
+    pending = []
+    if num_workers > 1 and not test_walks:
+        model.share_memory() # fork-inherit parameters without copying
+        # hand workers the eager module: an OptimizedModule wrapper from
+        # compile_grammar does not survive pickling on spawn-based pools
+        initargs = (getattr(model, '_orig_mod', model), G, graph, all_nodes, sample_args)
+        pool = Pool(num_workers, initializer=_init_walk_worker, initargs=initargs)
+    while new_novel < args.num_generate_samples:
+        n = base_nodes[index%len(base_nodes)]
         index += 1
-        if ':' in n: 
-            continue      
         if test_walks:
             if test_index < len(eval_trajs):
                 traj = eval_trajs[test_index]
@@ -1366,22 +1753,29 @@ def sample_walks(args,
                 test_index += 1
             else:
                 break
-        else:      
+        else:
             num_sampled += 1
-            traj, good = sample_walk(n, G, graph, model, all_nodes, 
-                                     loop_back='group-contrib' in os.environ['dataset'], 
-                                     min_thresh=args.min_thresh, 
-                                     softmax=args.softmax)                   
+            if pool is not None:
+                if not pending:
+                    # walks are independent per start node, so sample the next
+                    # num_workers starts in one shot and drain them one per loop
+                    shard = [(base_nodes[(index-1+k)%len(base_nodes)],
+                              int(np.random.randint(2**31)))
+                             for k in range(num_workers)]
+                    pending = pool.map(_sample_walk_shard, shard)
+                traj, good = pending.pop(0)
+            else:
+                traj, good = sample_walk(n, G, graph, model, all_nodes, **sample_args)
             # print(traj)
         if len(traj) > 1 and good:
             num_tried += 1
             name_traj = process_good_traj(traj, all_nodes)
             assert len(traj) == len(name_traj)
             try: # test for validity                
-                root, edge_conn = verify_walk(r_lookup, 
-                                              G, 
-                                              name_traj, 
-                                              **kwargs)
+                root, edge_conn = _verify_cached(r_lookup, 
+                                                 G, 
+                                                 name_traj, 
+                                                 **kwargs)
             except Exception as e:                
                 if isinstance(e, KeyError): # invalid walk
                     # print(e)
@@ -1394,11 +1788,14 @@ def sample_walks(args,
                     elif "is not valid" in str(e):
                         chemical_invalid += 1
                     else:
-                        breakpoint()
+                        if _debug_checks:
+                            raise
+                        chemical_invalid += 1
                     continue
                 else:
-                    breakpoint()
-                    # print(e)                
+                    if _debug_checks:
+                        raise
+                    # print(e)
                     continue
             DiffusionGraph.value_count(root, {}) # modifies edge_conn with :'s too
             name_traj = '->'.join(name_traj)
@@ -1433,8 +1830,11 @@ def sample_walks(args,
                 print(f"{name_traj} discovered")
             num_valid += 1            
         # print(f"add {new_novel} samples, now {len(novel)} novel samples, validity: {num_valid}/{num_tried}")
-    if not (nx.adjacency_matrix(G).toarray() == graph.adj).all():
-        breakpoint()    
+    if pool is not None:
+        pool.close()
+    if __debug__ and getattr(args, 'debug_adj', False):
+        if not (nx.adjacency_matrix(G).toarray() == graph.adj).all():
+            breakpoint()    
     if return_metrics:
         metrics = {                   
                    'num_sampled': num_sampled, # total number of trajectories
@@ -1473,45 +1873,74 @@ def extract_all_walks(args, G, graph, seen_dags, model, all_nodes, r_lookup, pre
     return trajs
 
 
+# fixed extract_rule arguments, installed once per worker by the pool
+# initializer instead of re-pickled into every task tuple
+_rule_worker_state = {}
+
+
+def _init_rule_worker(model, G, graph, all_nodes, r_lookup, loop_back, max_thresh, min_thresh):
+    _rule_worker_state.update(model=model, G=G, graph=graph, all_nodes=all_nodes,
+                              r_lookup=r_lookup, loop_back=loop_back,
+                              max_thresh=max_thresh, min_thresh=min_thresh)
+
+
+def _extract_rule_star(parg):
+    n, depth = parg
+    s = _rule_worker_state
+    return extract_rule(n, s['G'], s['graph'], s['model'], s['all_nodes'],
+                        s['loop_back'], s['max_thresh'], s['min_thresh'],
+                        depth, s['r_lookup'])
+
+
+def _verify_rule_pair(parg):
+    rule_a, rule_b, probs, r_lookup, G, loop_back = parg
+    if len(rule_a) > 1:
+        try:
+            verify_walk(r_lookup, G, rule_a, loop_back=loop_back)
+        except:
+            print(rule_a, "is invalid")
+            return None
+    if len(rule_b) > 1:
+        try:
+            verify_walk(r_lookup, G, rule_b, loop_back=loop_back)
+        except:
+            print(rule_b, "is invalid")
+            return None
+    return (rule_a, rule_b, probs)
+
+
 def extract_rules(args, G, graph, seen_dags, model, all_nodes, r_lookup, predefined_graph, **kwargs):
     pargs = []
+    loop_back = 'group-contrib' in os.environ['dataset']
+    depth = -1 if kwargs.get('best_first') else kwargs['max_depth']
     for n in G:
-        if ':' in n: 
+        if ':' in n:
             continue
-        if 'best_first' in kwargs and kwargs['best_first']:
-            depth = -1
-            pargs.append((n, 
-                            G, 
-                            graph, 
-                            model, 
-                            all_nodes, 
-                            'group-contrib' in os.environ['dataset'], 
-                            args.max_thresh, 
-                            args.min_thresh, 
-                            depth,
-                            r_lookup))
-        else:
-            pargs.append((n, 
-                            G, 
-                            graph, 
-                            model, 
-                            all_nodes, 
-                            'group-contrib' in os.environ['dataset'], 
-                            args.max_thresh, 
-                            args.min_thresh, 
-                            depth))
-    # with Pool(50) as p:
-    #     res = p.starmap(extract_rule, tqdm(pargs))
-    res = [extract_rule(*parg) for parg in pargs]
-    trajs = sum(res, [])
+        pargs.append((n, depth))
+    # node roots are independent, so farm the heavy extract_rule calls out to
+    # a pool once there are enough of them to amortize the fork/IPC cost;
+    # everything but (n, depth) is identical across tasks, so it goes through
+    # the initializer once per worker rather than into every task tuple
+    initargs = (model, G, graph, all_nodes, r_lookup, loop_back,
+                args.max_thresh, args.min_thresh)
+    if len(pargs) >= 500 and os.cpu_count() > 1:
+        model.share_memory() # weights land in shared memory instead of per-task pickles
+        with torch_mp.Pool(min(os.cpu_count(), len(pargs)),
+                           initializer=_init_rule_worker, initargs=initargs) as p:
+            chunksize = max(1, len(pargs)//(4*os.cpu_count()))
+            res = list(p.imap(_extract_rule_star, pargs, chunksize=chunksize))
+    else:
+        _init_rule_worker(*initargs)
+        res = [_extract_rule_star(parg) for parg in pargs]
+    trajs = list(chain.from_iterable(res))
     return trajs
     
 
 
 def load_dags(args):
-    data = pickle.load(open(args.dags_file, 'rb'))    
-    data_copy = deepcopy(data)
+    data = pickle.load(open(args.dags_file, 'rb'))
     dags = []
+    dag_ids = {}
     if hasattr(args, 'smiles_file'):
         smiles = open(args.smiles_file).readlines()
     for k, v in data.items():
@@ -1523,45 +1952,39 @@ def load_dags(args):
         # if root_node.children:
         root_node.dag_id = k
         dags.append(root_node)
-    return data, dags   
-
-
-def attach_smiles(args, all_dags):
-    lines = open(args.walks_file).readlines()
-    dag_ids = {}
-    for dag in all_dags:
-        dag_ids[dag.dag_id] = dag
-    if 'polymer_walks' in args.walks_file:
+        dag_ids[k] = root_node
+    return data, dags, dag_ids
+
+
+def attach_smiles(args, all_dags, dag_ids=None):
+    if dag_ids is None: # callers that went through load_dags pass the lookup in
+        dag_ids = {dag.dag_id: dag for dag in all_dags}
+    # pick the line parser once instead of re-testing the filename per line
+    wf = args.walks_file
+    if any(key in wf for key in ('permeability', 'crow', 'HOPV', 'PTC', 'lipophilicity')):
+        parse = lambda l: l.rstrip('\n').split(',')[0]
+    elif 'smiles_and_props' in wf:
+        parse = lambda l: l.rstrip('\n').split()[0]
+    elif 'polymer_walks' in wf:
+        parse = None
+    else:
+        raise ValueError(f"no smiles parser for {wf}")
+    if not args.concat_mol_feats:
+        return
+    smiles_it = None
+    if parse is None:
         assert hasattr(args, 'smiles_file')
-        all_smiles = open(args.smiles_file).readlines()
-        if len(dag_ids) != len(all_smiles):
-            breakpoint()
-        polymer_smiles = {}
-        for i, l in zip(dag_ids, all_smiles):
-            if l == '\n':
-                smiles = ''
-            else:
-                smiles = l.split(',')[0]
-            polymer_smiles[i] = smiles
-    for i, l in enumerate(lines):        
+        smiles_it = open(args.smiles_file) # streamed alongside the walks file
+    # single fused pass: the k-th dag consumes the k-th smiles line
+    for i, l in enumerate(open(wf)):
         if i not in dag_ids: continue
-        if 'permeability' in args.walks_file:
-            smiles = l.rstrip('\n').split(',')[0]
-        elif 'crow' in args.walks_file or 'HOPV' in args.walks_file:
-            smiles = l.rstrip('\n').split(',')[0]
-        elif 'polymer_walks' in args.walks_file:
-            if args.concat_mol_feats:
-                smiles = polymer_smiles[i]
-        elif 'PTC' in args.walks_file:
-            smiles = l.rstrip('\n').split(',')[0]
-        elif 'lipophilicity' in args.walks_file:
-            smiles = l.rstrip('\n').split(',')[0]
-        elif 'smiles_and_props' in args.walks_file:
-            smiles = l.rstrip('\n').split()[0]
+        if parse is None:
+            sl = next(smiles_it, None)
+            if sl is None:
+                raise ValueError(f"fewer smiles than the {len(dag_ids)} dags")
+            dag_ids[i].smiles = '' if sl == '\n' else sl.split(',')[0]
         else:
-            breakpoint()
-        if args.concat_mol_feats:
-            dag_ids[i].smiles = smiles   
+            dag_ids[i].smiles = parse(l)
 
 
 
@@ -1572,14 +1995,13 @@ def prune_walk(args, graph, walks):
             conn, W, prop = walks[i]
         else:
             conn, W = walks[i]
-        pruned = []
-        for j, edge in enumerate(conn):
-            a, b, e = edge
-            try:
-                w = W[graph.index_lookup[a.val]][graph.index_lookup[b.val]].item()
-            except:
-                breakpoint()
-            pruned.append((a, b, e, w))
+        idx = graph.index_lookup
+        rows = np.fromiter((idx[a.val] for a, _, _ in conn), dtype=np.int64, count=len(conn))
+        cols = np.fromiter((idx[b.val] for _, b, _ in conn), dtype=np.int64, count=len(conn))
+        # one C-level batched gather instead of a per-edge .item() round-trip
+        W_np = W.detach().cpu().numpy() if torch.is_tensor(W) else np.asarray(W)
+        ws = W_np[rows, cols].tolist() if len(conn) else []
+        pruned = [(a, b, e, w) for (a, b, e), w in zip(conn, ws)]
         if 'group-contrib' in args.walks_file and not pruned:
             breakpoint()
         if len(walks[i]) == 3:
@@ -1603,15 +2025,20 @@ def run_checks():
 
 def vis_processed(mol, path):
     # remove reds
-    ed_mol = Chem.EditableMol(mol)        
+    ed_mol = Chem.RWMol(mol)
     to_remove = []
-    for j in range(mol.GetNumAtoms()):
-        if mol.GetAtomWithIdx(j).GetBoolProp('r'):
-            if '_' not in mol.GetAtomWithIdx(j).GetProp('a'):
-                to_remove.append(j)
-    for j in sorted(to_remove, key=lambda x:-x):
-        ed_mol.RemoveAtom(j)
-    mol = ed_mol.GetMol()    
+    for j, atom in enumerate(mol.GetAtoms()): # one FFI crossing per atom
+        if atom.GetBoolProp('r') and '_' not in atom.GetProp('a'):
+            to_remove.append(j)
+    if hasattr(ed_mol, 'BeginBatchEdit'): # single reindex pass on modern rdkit
+        ed_mol.BeginBatchEdit()
+        for j in to_remove:
+            ed_mol.RemoveAtom(j)
+        ed_mol.CommitBatchEdit()
+    else:
+        for j in sorted(to_remove, reverse=True):
+            ed_mol.RemoveAtom(j)
+    mol = ed_mol.GetMol()
     mol.UpdatePropertyCache(strict=False)
     vis_mol(mol, path)    
     return mol
@@ -1621,24 +2048,22 @@ def vis_processed(mol, path):
 def main(args):
     walks = load_walks(args)
     diffusion_args = {k[len('diffusion_'):]: v for (k, v) in args.__dict__.items() if 'diffusion' in k}
-    graph = nx.read_edgelist(args.predefined_graph_file, create_using=nx.MultiDiGraph)
     predefined_graph = nx.read_edgelist(args.predefined_graph_file, create_using=nx.MultiDiGraph)
+    graph = predefined_graph.copy() # parse the edge list once; copy() is far cheaper
     mols = load_mols(args.motifs_folder)
     red_grps = annotate_extra(mols, args.extra_label_path)  
     r_lookup = r_member_lookup(mols)
     num_nodes = len(graph.nodes())
     index_lookup = dict(zip(graph.nodes(), range(num_nodes)))
-    data = pickle.load(open(args.dags_file, 'rb'))
-    data_copy = deepcopy(data)
-    _, dags = load_dags(args)        
+    data, dags, dag_ids = load_dags(args)
     graph = DiffusionGraph(dags, graph, **diffusion_args) 
     G = graph.graph
     N = len(G)
     all_nodes = list(G.nodes())
-    diffusion_args['adj_matrix'] = nx.adjacency_matrix(G).toarray()    
+    diffusion_args['adj_matrix'] = graph.adj # dense adjacency already built by DiffusionGraph
     loop_back = 'group-contrib' in os.environ['dataset']
-    data, dags = load_dags(args)
-    seen_dags = deepcopy(dags)      
+    # snapshot via pickle round-trip: cheaper than deepcopy for dag trees
+    seen_dags = pickle.loads(pickle.dumps(dags))      
 
     ### Produce SMILES from list of walks for dataset release    
     # r_lookup = r_member_lookup(mols)
@@ -1698,19 +2123,24 @@ def main(args):
         model = L_grammar(len(graph.graph), diffusion_args)
         state = torch.load(os.path.join(args.log_folder, 'ckpt.pt'))
         model.load_state_dict(state)
+        if args.compile:
+            # opt-in: compilation pays off for the fixed-shape walk_edge_weight
+            # batches, but the samplers call the model with a growing int t,
+            # which torch.compile re-specializes on every new value
+            model = compile_grammar(model)
         E = model.E
+        E_list = E.detach().cpu().tolist() # one transfer instead of N^2 .item() syncs
         E_dic = defaultdict(dict)
-        for i in range(E.shape[0]):
-            for j in range(E.shape[1]):
-                a, b = all_nodes[i], all_nodes[j]
-                E_dic[a][b] = E[i][j].item()
-        json.dump(E_dic, open(os.path.join(args.log_folder, 'E.json'), 'w+'))
+        for i, a in enumerate(all_nodes):
+            row = E_list[i]
+            E_dic[a] = {all_nodes[j]: row[j] for j in range(len(row))}
+        _json_dump(E_dic, os.path.join(args.log_folder, 'E.json'))
     else:        
         log_dir = os.path.join('logs/', f'logs-{time.time()}/')
         setattr(args, 'log_folder', log_dir)
         os.makedirs(log_dir, exist_ok=True)
         with open(os.path.join(log_dir, 'config.json'), 'w+') as f:
-            json.dump(json.dumps(args.__dict__), f)        
+            json.dump(args.__dict__, f, default=str)        
         model = diffuse(graph, log_dir, **diffusion_args)
     
     graph.reset()
@@ -1721,7 +2151,7 @@ def main(args):
 
     ### Sample new ones and compute metrics from existing SMILES
     # old_smiles = open('/home/msun415/polymer_walk/data/polymer_walks_v2_smiles.txt').readlines()
-    # old_smiles = [old_smile for old_smile in old_smiles if Chem.MolFromSmiles(old_smile) is not None]
+    # old_smiles = [old_smile for old_smile in old_smiles if _parse_smi(old_smile) is not None]
     # options = {'best_first': True}
     # all_walks = extract_all_walks(args, G, graph, seen_dags, model, all_nodes, r_lookup, predefined_graph, **options)    
     # all_walks = pickle.load(open('/home/msun415/polymer_walk/data/polymer_all_walks_1000.pkl', 'rb'))
@@ -1766,28 +2196,24 @@ def main(args):
                             conn.append((b.id, a.id, b.val, a.val, e, p))                    
                     visualize_rule(args, title, conn, os.path.join(args.rule_vis_folder, f"rule_{i}.md"))
         else:
-            all_rules = {}
             options = {'max_thresh': args.max_thresh,
                     'min_thresh': args.min_thresh}
-            for d in range(2, args.max_rule_depth):
-                rules = extract_rules(args, G, graph, seen_dags, model, all_nodes, r_lookup, predefined_graph, depth=d, **options)
-                all_rules[d] = []
-                for rule_a, rule_b, probs in rules:
-                    rule_a = process_good_traj(rule_a, all_nodes)
-                    rule_b = process_good_traj(rule_b, all_nodes)
-                    if len(rule_a) > 1:
-                        try:
-                            verify_walk(r_lookup, G, rule_a, loop_back=loop_back)
-                        except:
-                            print(rule_a, "is invalid")
-                            continue
-                    if len(rule_b) > 1:
-                        try:
-                            verify_walk(r_lookup, G, rule_b, loop_back=loop_back)                           
-                        except:
-                            print(rule_b, "is invalid")
-                            continue                    
-                    all_rules[d].append((rule_a, rule_b, probs))
+            # one shared-prefix traversal per root covers every depth in
+            # 2..max_rule_depth-1, instead of re-running extraction per depth
+            rules = extract_rules(args, G, graph, seen_dags, model, all_nodes, r_lookup, predefined_graph, max_depth=args.max_rule_depth, **options)
+            pargs = [(process_good_traj(rule_a, all_nodes),
+                      process_good_traj(rule_b, all_nodes),
+                      probs, r_lookup, G, loop_back) for _, rule_a, rule_b, probs in rules]
+            # rule verifications are independent; parallelize the long tails
+            if len(pargs) >= 500 and os.cpu_count() > 1:
+                with Pool(os.cpu_count()) as p:
+                    res = p.map(_verify_rule_pair, pargs, chunksize=64)
+            else:
+                res = [_verify_rule_pair(parg) for parg in pargs]
+            all_rules = {d: [] for d in range(2, args.max_rule_depth)}
+            for (d, *_), r in zip(rules, res):
+                if r is not None:
+                    all_rules[d].append(r)
             if args.save_rules_path:
                 json.dump(all_rules, open(args.save_rules_path, 'w+'))
                 rules_txt_path = args.save_rules_path.replace('.json', '.txt')
@@ -1798,7 +2224,7 @@ def main(args):
                 f.close()
     else:
         if args.concat_mol_feats:
-            attach_smiles(args, dags)
+            attach_smiles(args, dags, dag_ids)
             old_smiles = [dag.smiles for dag in dags]
         if args.compute_train_metrics:
             train_data_metrics = compute_metrics(args, mols, None, old_smiles, retro_suffix='_train')
@@ -1812,7 +2238,7 @@ def main(args):
                                               r_lookup, 
                                               diffusion_args,
                                               return_metrics=True,
-                                              loop_back='group-contrib' in os.environ['dataset'])
+                                              loop_back=loop_back)
         breakpoint()
         if args.compute_metrics:            
             new_smiles = [dag.smiles for dag in new_dags]
@@ -1834,7 +2260,10 @@ def main(args):
         with open(os.path.join(args.log_folder, 'novel.txt'), 'w+') as f:
             for n in novel:
                 f.write(n[0]+'\n')
-        # pickle.dump(novel, open(os.path.join(args.logs_folder, 'novel.pkl', 'wb+')))                
+        # pickle.dump(novel, open(os.path.join(args.logs_folder, 'novel.pkl', 'wb+')))
+        # when re-enabling the all_walks['old'] loop below, use the batched
+        # W_adjs = walk_edge_weights(dags, graph, model, [graph.lookup_process(d.dag_id) for d in dags])
+        # instead of one walk_edge_weight call per dag
         # for i, dag in enumerate(dags):
         #     proc = graph.lookup_process(dag.dag_id)
         #     for j in range(len(proc.dfs_order)-1):
@@ -1861,15 +2290,15 @@ def main(args):
         if 'group-contrib' in args.walks_file:
             for name_traj, root, edge_conn, W_adj in novel: # (name_traj, root, edge_conn, W_adj)
                 assert not (edge_conn[-1][0].id and edge_conn[-1][1].id) # last edge is assumed to have root
-            all_walks['novel'] = [(edge_conn[:-1], W_adj) for x in novel] # all edges except last edge
+            # all edges except last edge
+            all_walks['novel'] = [(edge_conn[:-1], W_adj) for (name_traj, root, edge_conn, W_adj) in novel]
         else:
-            for name_traj, root, edge_conn, W_adj in novel:
-                all_walks['novel'] = [(edge_conn, W_adj) for x in novel] # all edges except last edge        
+            all_walks['novel'] = [(edge_conn, W_adj) for (name_traj, root, edge_conn, W_adj) in novel]
 
         all_walks['novel'] = prune_walk(args, graph, all_walks['novel'])                
         all_walks['novel'] = [write_conn(x, G) for (i, x) in enumerate(all_walks['novel'])]
         print("novel", novel)
-        json.dump(all_walks, open(os.path.join(args.log_folder, 'all_dags.json'), 'w+'))
+        _json_dump(all_walks, os.path.join(args.log_folder, 'all_dags.json'))
         print("saved to", os.path.join(args.log_folder, 'all_dags.json'))
         
 
@@ -1893,8 +2322,11 @@ if __name__ == "__main__":
     parser.add_argument('--alpha', dest='diffusion_alpha', default=1e-4, type=float)
     parser.add_argument('--opt', dest='diffusion_opt', default='adam')
     parser.add_argument('--num_epochs', dest='diffusion_num_epochs', default=500, type=int)
+    parser.add_argument('--compile', dest='diffusion_compile', action='store_true')
     # sampling params
-    parser.add_argument('--num_generate_samples', type=int, default=15)      
+    parser.add_argument('--num_generate_samples', type=int, default=15)
+    parser.add_argument('--debug_adj', action='store_true', help='check graph.adj against nx.adjacency_matrix')
+    parser.add_argument('--sample_workers', type=int, default=0, help='parallelize walk sampling over this many workers')      
     parser.add_argument('--compute_train_metrics', action='store_true', help='compute train metrics')
     parser.add_argument('--compute_metrics', action='store_true', help='compute test metrics')
     parser.add_argument('--compute_metrics_baselines', help='if given, compute metrics for these files of smiles', nargs='+')
@@ -299,9 +299,9 @@ def train(args, dags, graph, diffusion_args, props, norm_props, mol_feats, feat_
 
     G = graph.graph  
     N = len(G)    
-    diffusion_args['adj_matrix'] = nx.adjacency_matrix(G).toarray()
+    diffusion_args['adj_matrix'] = graph.adj
     if diffusion_args['e_init']:
-        diffusion_args['init_e'] = nx.adjacency_matrix(G).toarray()    
+        diffusion_args['init_e'] = graph.adj
     model = L_grammar(len(G), diffusion_args)
     state = torch.load(os.path.join(args.grammar_folder, 'ckpt.pt'))
     model.load_state_dict(state)
@@ -835,14 +835,15 @@ def main(args):
             # Optimize Loss(S^(t-1)+alpha*L(;S^(t-1)), S^(t))
 
     # in: graph G, n walks, m groups, F, f, E edge weights
-    data, dags = load_dags(args)
+    data, dags, dag_ids = load_dags(args)
 
-    config_json = json.loads(json.load(open(os.path.join(args.grammar_folder,'config.json'),'r')))
+    config_json = json.load(open(os.path.join(args.grammar_folder,'config.json'),'r'))
+    if isinstance(config_json, str): # configs written before the double-encoding fix
+        config_json = json.loads(config_json)
     diffusion_args = {k[len('diffusion_'):]: v for (k, v) in config_json.items() if 'diffusion' in k}
 
-    graph = nx.read_edgelist(args.predefined_graph_file, create_using=nx.MultiDiGraph)
-    graph = DiffusionGraph(dags, graph, **diffusion_args)
-    predefined_graph = nx.read_edgelist(args.predefined_graph_file, create_using=nx.MultiDiGraph)    
+    predefined_graph = nx.read_edgelist(args.predefined_graph_file, create_using=nx.MultiDiGraph)
+    graph = DiffusionGraph(dags, predefined_graph.copy(), **diffusion_args)
     G = graph.graph
     N = len(G)   
     all_nodes = list(G.nodes())   
@@ -973,10 +974,10 @@ def main(args):
         feat_lookup = {}
         
     if args.concat_mol_feats:
-        attach_smiles(args, dags)
+        attach_smiles(args, dags, dag_ids)
         input_dim += 2048
     setattr(args, 'input_dim', input_dim)
-    diffusion_args['adj_matrix'] = nx.adjacency_matrix(G).toarray()
+    diffusion_args['adj_matrix'] = graph.adj
 
     if args.predictor_file and args.grammar_file:    
         setattr(args, 'logs_folder', os.path.dirname(args.predictor_file))            
@@ -984,7 +985,9 @@ def main(args):
         state = torch.load(args.grammar_file)
         model.load_state_dict(state)
         assert os.path.exists(os.path.join(args.logs_folder, 'config.json'))
-        config = json.loads(json.load(open(os.path.join(args.logs_folder, 'config.json'))))
+        config = json.load(open(os.path.join(args.logs_folder, 'config.json')))
+        if isinstance(config, str): # configs written before the double-encoding fix
+            config = json.loads(config)
         predictor = Predictor(num_heads=len(args.property_cols), **config)
         state = torch.load(os.path.join(args.predictor_file))
         predictor.load_state_dict(state)  
@@ -997,7 +1000,7 @@ def main(args):
         setattr(args, 'logs_folder', predictor_path)
         setattr(args, 'TORCH_SEED', int(os.environ.get('TORCH_SEED', '-1')))
         with open(os.path.join(predictor_path, 'config.json'), 'w+') as f:
-            json.dump(json.dumps(args.__dict__), f)  
+            json.dump(args.__dict__, f, default=str)  
 
         props, norm_props, dags, mask = preprocess_data(dags, args, args.logs_folder)            
         model, predictor = train(args, dags, graph, diffusion_args, props, norm_props, mol_feats, feat_lookup)
@@ -144,8 +144,8 @@ def write_conn(conn, G):
             a,b,e,w = c
         else:
             a,b,e = c
-        a_val = a.val.split(':')[0]
-        b_val = b.val.split(':')[0]
+        a_val = a.short_val
+        b_val = b.short_val
         if e is not None:
             try:
                 e = G[a_val][b_val][e]
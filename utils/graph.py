@@ -24,6 +24,14 @@ class Node:
         self.id = id
         self.side_chain = side_chain
 
+    @property
+    def short_val(self):
+        # val without the :count suffix, re-split only when val changes
+        if getattr(self, '_short_for', None) != self.val:
+            self._short_for = self.val
+            self._short_val = self.val.split(':', 1)[0]
+        return self._short_val
+
     def add_child(self, child):
         self.children.append(child)
 
@@ -112,7 +120,7 @@ def dag_to_graph(dag):
             if isinstance(j, tuple):
                 j = j[0]
             if j.id:
-                graph.add_node(j.id, val=j.val.split(':')[0])
+                graph.add_node(j.id, val=j.short_val)
                 bfs.append(j)
     return graph
 
@@ -744,9 +752,9 @@ def verify_edge_conn(graph, conn, r_lookup):
             continue
         red_j1 = graph[a.val][b.val][i]['r_grp_1']
         red_j2 = graph[a.val][b.val][i]['r_grp_2']
-        if not tuple(red_j1) in set(tuple(x) for x in r_lookup[a.val.split(':')[0]].values()):
+        if not tuple(red_j1) in set(tuple(x) for x in r_lookup[a.short_val].values()):
             breakpoint()
-        if not tuple(red_j2) in set(tuple(x) for x in r_lookup[b.val.split(':')[0]].values()):
+        if not tuple(red_j2) in set(tuple(x) for x in r_lookup[b.short_val].values()):
             breakpoint()
         if set(red_j1) & used_reds[a.id]:
             continue
@@ -831,7 +839,7 @@ def verify_walk(r_lookup, graph, walk, loop_back=False, return_all=False, check_
             tracks all possible connections, then prunes the isomorphic
             copies at each step
             """                
-            walk = [(str(a.id), str(b.id), a.val.split(':')[0], b.val.split(':')[0]) for (a,b) in conn]
+            walk = [(str(a.id), str(b.id), a.short_val, b.short_val) for (a,b) in conn]
             chosen_edges, new_mol = walk_enumerate_mols(walk, 
                                                         graph, 
                                                         mols, 